@@ -1,35 +1,112 @@
 import asyncio
+import base64
+import functools
+import ipaddress
+import json
+import os
+import re
 import subprocess
-from typing import List
+import time
+import zlib
+from typing import AsyncIterator, List, Optional, Tuple
+from urllib.parse import urlsplit
 
+import aiohttp
 import chainlit as cl
 from chainlit.input_widget import Select, Slider, Switch, TextInput
 
+try:
+    # Faster parsing of the per-token JSON lines Ollama streams back.
+    from orjson import loads as json_loads
+except ImportError:
+    json_loads = json.loads
+
 """Ollama × Chainlit chat app with:
 - Dynamic ChatProfiles per local model
 - Chat Settings panel (model, temperature, streaming, system prompt)
-- Async streaming of tokens
+- Async streaming of tokens over Ollama's REST API
 - Toast notifications for user feedback
 - Windows‑safe UTF‑8 decoding for all subprocess output
 """
 
+
+DEFAULT_OLLAMA_URL = "http://localhost:11434"
+
+
+def _ollama_url() -> str:
+    """Return the Ollama server URL from OLLAMA_HOST.
+
+    A bare host or host:port gets http:// and, if no port is given, 11434.
+    A value with an explicit scheme is used as-is (its path included), so
+    its port defaults to the scheme's. Invalid values are logged and fall
+    back to DEFAULT_OLLAMA_URL.
+    """
+    raw = os.environ.get("OLLAMA_HOST", "").strip().strip("\"'").strip()
+    if not raw:
+        return DEFAULT_OLLAMA_URL
+    try:
+        if "://" in raw:
+            parts = urlsplit(raw)
+            parts.port  # validates the port, raising ValueError if bad
+            if not parts.hostname:
+                raise ValueError("missing host")
+            return raw.rstrip("/")
+
+        try:
+            # Bare IPv6 literal such as "::1"
+            hostname, port = f"[{ipaddress.IPv6Address(raw)}]", None
+        except ValueError:
+            parts = urlsplit(f"http://{raw}")
+            hostname, port = parts.hostname or "localhost", parts.port
+            if ":" in hostname:
+                hostname = f"[{hostname}]"
+        return f"http://{hostname}:{port or 11434}"
+    except ValueError as e:
+        print(f"[ERROR] Invalid OLLAMA_HOST {raw!r} ({e}); using {DEFAULT_OLLAMA_URL}")
+        return DEFAULT_OLLAMA_URL
+
+
+OLLAMA_URL = _ollama_url()
+MODEL_LIST_TTL = 30  # seconds
+
+# Give up on a connect after 3 s and on a stream that stays silent for 60 s
+# (long enough for Ollama to load a model before its first token).
+OLLAMA_TIMEOUT = aiohttp.ClientTimeout(total=None, sock_connect=3, sock_read=60)
+GENERATE_RETRIES = 2
+RETRY_BACKOFF = 0.5  # seconds, doubled on each retry
+
+# Keep idle pooled connections for 5 minutes (matching Ollama's default
+# keep_alive) rather than aiohttp's 15 s, so the connection warmed up in
+# start_chat is still open when the user sends a message after thinking.
+KEEPALIVE_TIMEOUT = 300  # seconds
+
+# Shared across sessions so HTTP connections to Ollama are reused.
+_http_session: Optional[aiohttp.ClientSession] = None
+
 # --------------------------------------------------
 # Utils
 # --------------------------------------------------
 
+@functools.lru_cache(maxsize=1)
+def _list_local_models_cached(bucket: int) -> Tuple[str, ...]:
+    """Run "ollama list" once per time bucket; errors propagate uncached."""
+    out = subprocess.check_output(["ollama", "list"], stderr=subprocess.DEVNULL)
+    # Skip header row; only the name column is decoded (always as UTF-8).
+    return tuple(
+        line.split(None, 1)[0].decode("utf-8", errors="replace")
+        for line in out.splitlines()[1:]
+        if line.strip()
+    )
+
+
 def list_local_models() -> List[str]:
-    """Return the list of local Ollama model names ("ollama list")."""
+    """Return the list of local Ollama model names ("ollama list").
+
+    Results are cached for MODEL_LIST_TTL seconds so that building chat
+    profiles and starting a chat don't each fork the CLI.
+    """
     try:
-        result = subprocess.run(
-            ["ollama", "list"],
-            capture_output=True,
-            text=True,
-            encoding="utf-8",
-            check=True,
-        )
-        lines = result.stdout.strip().splitlines()
-        # Skip header row
-        return [line.split()[0] for line in lines[1:] if line.strip()]
+        return list(_list_local_models_cached(int(time.time()) // MODEL_LIST_TTL))
     except Exception as e:
         print(f"[ERROR] Could not list Ollama models: {e}")
         return []
@@ -39,6 +116,24 @@ def list_local_models() -> List[str]:
 # Chat Profiles
 # --------------------------------------------------
 
+def make_icon(seed: str, label: str) -> str:
+    """Return an inline SVG data URI: a circle coloured by *seed* with *label*'s initials.
+
+    Built locally so profile icons don't trigger remote image fetches.
+    """
+    hue = zlib.crc32(seed.encode("utf-8")) % 360
+    words = re.findall(r"[A-Za-z0-9]+", label)
+    initials = "".join(word[0] for word in words)[:2].upper() or "?"
+    svg = (
+        '<svg xmlns="http://www.w3.org/2000/svg" width="210" height="210" viewBox="0 0 210 210">'
+        f'<circle cx="105" cy="105" r="105" fill="hsl({hue},55%,45%)"/>'
+        '<text x="50%" y="50%" dy=".35em" text-anchor="middle" fill="#fff" '
+        f'font-family="sans-serif" font-size="84" font-weight="bold">{initials}</text>'
+        "</svg>"
+    )
+    return "data:image/svg+xml;base64," + base64.b64encode(svg.encode("utf-8")).decode("ascii")
+
+
 def build_chat_profiles() -> List[cl.ChatProfile]:
     """Build a Chainlit ChatProfile for every local Ollama model."""
     models = list_local_models()
@@ -53,7 +148,7 @@ def build_chat_profiles() -> List[cl.ChatProfile]:
             cl.ChatProfile(
                 name="no-models",
                 markdown_description="No local Ollama models found.",
-                icon="https://picsum.photos/seed/empty/210",
+                icon=make_icon("no-models", "?"),
             )
         ]
 
@@ -63,7 +158,7 @@ def build_chat_profiles() -> List[cl.ChatProfile]:
             cl.Starter(
                 label=label,
                 message=msg,
-                icon=f"https://picsum.photos/seed/{model.replace(':','_')}_{i}/200",
+                icon=make_icon(f"{model}_{i}", label),
             )
             for i, (label, msg) in enumerate(starters_tpl)
         ]
@@ -71,7 +166,7 @@ def build_chat_profiles() -> List[cl.ChatProfile]:
             cl.ChatProfile(
                 name=model,
                 markdown_description=f"**{model}** running through Ollama.",
-                icon=f"https://picsum.photos/seed/{model.replace(':','_')}/210",
+                icon=make_icon(model, model),
                 starters=starters,
             )
         )
@@ -80,57 +175,118 @@ def build_chat_profiles() -> List[cl.ChatProfile]:
 
 @cl.set_chat_profiles
 async def chat_profile():
-    return build_chat_profiles()
+    # "ollama list" blocks, so keep it off the event loop.
+    return await asyncio.get_running_loop().run_in_executor(None, build_chat_profiles)
 
 
 # --------------------------------------------------
 # Ollama call helpers
 # --------------------------------------------------
 
-async def run_ollama(model: str, prompt: str, stream: bool):
-    """Run Ollama with the chosen model and prompt. Stream tokens if requested."""
-    if stream:
-        proc = await asyncio.create_subprocess_exec(
-            "ollama",
-            "run",
-            model,
-            prompt,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE,
+class OllamaError(Exception):
+    """Error reported by the Ollama server."""
+
+
+def get_http_session() -> aiohttp.ClientSession:
+    """Return the process-wide aiohttp session, creating it on first use."""
+    global _http_session
+    if _http_session is None or _http_session.closed:
+        _http_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(keepalive_timeout=KEEPALIVE_TIMEOUT),
+            timeout=OLLAMA_TIMEOUT,
         )
-        msg = cl.Message(content="")
-        buffer = b""
-        while True:
-            chunk = await proc.stdout.read(1)
-            if not chunk:
+    return _http_session
+
+
+async def _read_error(resp: aiohttp.ClientResponse) -> str:
+    """Extract Ollama's error message from a failed HTTP response."""
+    body = await resp.text()
+    try:
+        return json.loads(body).get("error", body).strip()
+    except (ValueError, AttributeError):
+        return body.strip() or f"HTTP {resp.status}"
+
+
+async def warm_up_connection() -> None:
+    """Open a pooled connection to Ollama before the user's first message."""
+    try:
+        async with get_http_session().get(
+            f"{OLLAMA_URL}/api/tags", timeout=aiohttp.ClientTimeout(total=2)
+        ) as resp:
+            # Drain the body so the connection goes back into the pool.
+            await resp.read()
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        pass
+
+
+async def _iter_lines(content: aiohttp.StreamReader) -> AsyncIterator[bytes]:
+    """Yield newline-delimited lines, taking all buffered bytes per read."""
+    pending = b""
+    async for chunk in content.iter_any():
+        *lines, pending = (pending + chunk).split(b"\n")
+        for line in lines:
+            yield line
+    if pending:
+        yield pending
+
+
+async def stream_ollama(model: str, prompt: str) -> AsyncIterator[str]:
+    """Yield response tokens from /api/generate as Ollama produces them."""
+    payload = {"model": model, "prompt": prompt, "stream": True}
+    async with get_http_session().post(f"{OLLAMA_URL}/api/generate", json=payload) as resp:
+        if resp.status != 200:
+            raise OllamaError(await _read_error(resp))
+        # Ollama streams one JSON object per line.
+        async for line in _iter_lines(resp.content):
+            if not line.strip():
+                continue
+            try:
+                data = json_loads(line)
+            except ValueError as e:
+                raise OllamaError(f"Invalid response from Ollama: {e}") from e
+            if "error" in data:
+                raise OllamaError(data["error"])
+            if data.get("response"):
+                yield data["response"]
+            if data.get("done"):
+                return
+
+
+async def run_ollama(model: str, prompt: str, stream: bool):
+    """Run Ollama with the chosen model and prompt. Stream tokens if requested.
+
+    Tokens are always read from Ollama as they arrive; with streaming off
+    they are collected and sent as a single message once generation ends.
+    A request that times out before producing any token is retried.
+    """
+    msg = cl.Message(content="")
+    parts: List[str] = []
+    error: Optional[str] = None
+    for attempt in range(GENERATE_RETRIES + 1):
+        try:
+            async for token in stream_ollama(model, prompt):
+                parts.append(token)
+                if stream:
+                    await msg.stream_token(token)
+            break
+        except asyncio.TimeoutError:
+            # Retrying after tokens were shown would duplicate output.
+            if parts or attempt == GENERATE_RETRIES:
+                error = "Timed out waiting for a response from Ollama."
                 break
-            buffer += chunk
-            if chunk in b" \n":
-                await msg.stream_token(buffer.decode("utf-8", errors="ignore"))
-                buffer = b""
-        if buffer:
-            await msg.stream_token(buffer.decode("utf-8", errors="ignore"))
-        await proc.wait()
-        if proc.returncode != 0:
-            stderr = (
-                await proc.stderr.read()
-            ).decode("utf-8", errors="ignore").strip()
-            await msg.update(content=f"[Ollama Error] {stderr}")
-        else:
-            await msg.send()
-    else:
-        result = subprocess.run(
-            ["ollama", "run", model, prompt],
-            capture_output=True,
-            text=True,
-            encoding="utf-8",
-        )
-        content = (
-            result.stdout.strip()
-            if result.returncode == 0
-            else f"[Ollama Error] {result.stderr.strip()}"
-        )
-        await cl.Message(content).send()
+            await asyncio.sleep(RETRY_BACKOFF * 2**attempt)
+        except OllamaError as e:
+            error = str(e)
+            break
+        except aiohttp.ClientError as e:
+            error = f"Could not reach Ollama: {e}"
+            break
+
+    if error:
+        msg.content = f"[Ollama Error] {error}"
+    elif not stream:
+        msg.content = "".join(parts).strip()
+    await msg.send()
 
 
 # --------------------------------------------------
@@ -140,18 +296,25 @@ async def run_ollama(model: str, prompt: str, stream: bool):
 @cl.on_chat_start
 async def start_chat():
     """Create settings panel & greet user."""
-    models = list_local_models()
+    models, _ = await asyncio.gather(
+        asyncio.get_running_loop().run_in_executor(None, list_local_models),
+        warm_up_connection(),
+    )
     if not models:
         await cl.Message("⚠️ No local Ollama models detected.").send()
         return
 
+    # Preselect the model of the chat profile the user picked.
+    model_index = {name: i for i, name in enumerate(models)}
+    initial_index = model_index.get(cl.user_session.get("chat_profile"), 0)
+
     default_settings = await cl.ChatSettings(
         [
             Select(
                 id="Model",
                 label="Ollama Model",
                 values=models,
-                initial_index=0,
+                initial_index=initial_index,
                 tooltip="Select the Ollama model to chat with.",
             ),
             Slider(